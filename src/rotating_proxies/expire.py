@@ -28,6 +28,8 @@ class Proxies:
     'Dead' proxies move to 'unchecked' after a timeout (they are called
     'reanimated'). This timeout increases exponentially after each
     unsuccessful attempt to use a proxy.
+
+    ``version`` is incremented each time proxy states change.
     """
 
     def __init__(self, proxy_list, backoff=None):
@@ -38,6 +40,7 @@ class Proxies:
         self.unchecked = set(self.proxies.keys())
         self.good = set()
         self.dead = set()
+        self.version = 0
 
         if backoff is None:
             backoff = exp_backoff_full_jitter
@@ -58,6 +61,8 @@ class Proxies:
         """
         if not proxy_address:
             return None
+        if proxy_address in self.proxies:
+            return proxy_address
         hostport = extract_proxy_hostport(proxy_address)
         return self.proxies_by_hostport.get(hostport, None)
 
@@ -75,6 +80,7 @@ class Proxies:
         self.unchecked.discard(proxy)
         self.good.discard(proxy)
         self.dead.add(proxy)
+        self.version += 1
 
         now = _time or time.time()
         state = self.proxies[proxy]
@@ -90,6 +96,7 @@ class Proxies:
 
         if proxy not in self.good:
             logger.debug("Proxy <%s> is GOOD", proxy)
+            self.version += 1
 
         self.unchecked.discard(proxy)
         self.dead.discard(proxy)
@@ -107,10 +114,23 @@ class Proxies:
                 self.dead.remove(proxy)
                 self.unchecked.add(proxy)
                 n_reanimated += 1
+        if n_reanimated:
+            self.version += 1
         return n_reanimated
 
+    def next_reanimation_time(self):
+        """
+        Return the time when the first dead proxy can be reanimated,
+        or None if there are no dead proxies.
+        """
+        if not self.dead:
+            return None
+        return min(self.proxies[p].next_check for p in self.dead)
+
     def reset(self):
         """Mark all dead proxies as unchecked"""
+        if self.dead:
+            self.version += 1
         for proxy in list(self.dead):
             self.dead.remove(proxy)
             self.unchecked.add(proxy)
@@ -1,18 +1,20 @@
-import codecs
 import logging
-from functools import partial
+from functools import lru_cache, partial
 from urllib.parse import urlsplit
 
 from scrapy import signals
 from scrapy.exceptions import CloseSpider, NotConfigured
 from scrapy.utils.misc import load_object
-from scrapy.utils.url import add_http_if_no_scheme
 from twisted.internet import task
 
 from .expire import Proxies, exp_backoff_full_jitter
+from .utils import ensure_scheme
 
 logger = logging.getLogger(__name__)
 
+# BanDetectionMiddleware._spider marker; None is a valid spider argument
+_UNBOUND = object()
+
 
 class RotatingProxyMiddleware:
     """
@@ -46,7 +48,9 @@ class RotatingProxyMiddleware:
     * ``ROTATING_PROXY_LIST``  - a list of proxies to choose from;
     * ``ROTATING_PROXY_LIST_PATH``  - path to a file with a list of proxies;
     * ``ROTATING_PROXY_LOGSTATS_INTERVAL`` - stats logging interval in seconds,
-      30 by default;
+      30 by default. ``proxies/*`` Scrapy stats are refreshed at the same
+      interval; when it is 0, they are only set when the engine starts and
+      when the spider is closed;
     * ``ROTATING_PROXY_CLOSE_SPIDER`` - When True, spider is stopped if
       there are no alive proxies. If False (default), then when there is no
       alive proxies all dead proxies are re-checked.
@@ -61,6 +65,23 @@ class RotatingProxyMiddleware:
       Default is 3600 (i.e. 60 min).
     """
 
+    __slots__ = (
+        "proxies",
+        "_get_random",
+        "_get_proxy",
+        "_slot_by_proxy",
+        "logstats_interval",
+        "reanimate_interval",
+        "stop_if_no_proxies",
+        "max_proxies_to_try",
+        "stats",
+        "log_task",
+        "_logged_version",
+        "reanimate_task",
+        "clock",
+        "__weakref__",  # signal handlers are connected as weak references
+    )
+
     def __init__(
         self,
         proxy_list,
@@ -73,6 +94,11 @@ class RotatingProxyMiddleware:
     ):
         backoff = partial(exp_backoff_full_jitter, base=backoff_base, cap=backoff_cap)
         self.proxies = Proxies(self.cleanup_proxy_list(proxy_list), backoff=backoff)
+        self._get_random = self.proxies.get_random
+        self._get_proxy = self.proxies.get_proxy
+        self._slot_by_proxy = {
+            proxy: self.get_proxy_slot(proxy) for proxy in self.proxies.proxies
+        }
         self.logstats_interval = logstats_interval
         self.reanimate_interval = 5
         self.stop_if_no_proxies = stop_if_no_proxies
@@ -80,15 +106,22 @@ class RotatingProxyMiddleware:
         self.stats = crawler.stats
 
         self.log_task = None
+        self._logged_version = None
         self.reanimate_task = None
 
+        from twisted.internet import reactor
+
+        # like LoopingCall.clock; replace with task.Clock in tests
+        self.clock = reactor
+
     @classmethod
     def from_crawler(cls, crawler):
         s = crawler.settings
         proxy_path = s.get("ROTATING_PROXY_LIST_PATH", None)
         if proxy_path is not None:
-            with codecs.open(proxy_path, "r", encoding="utf8") as f:
-                proxy_list = [line.strip() for line in f if line.strip()]
+            with open(proxy_path, encoding="utf8") as f:
+                # stripping is left to cleanup_proxy_list
+                proxy_list = list(filter(str.strip, f.read().splitlines()))
         else:
             proxy_list = s.getlist("ROTATING_PROXY_LIST")
         if not proxy_list:
@@ -104,33 +137,70 @@ class RotatingProxyMiddleware:
         )
         crawler.signals.connect(mw.engine_started, signal=signals.engine_started)
         crawler.signals.connect(mw.engine_stopped, signal=signals.engine_stopped)
+        crawler.signals.connect(mw.spider_closed, signal=signals.spider_closed)
         return mw
 
     def engine_started(self):
         if self.logstats_interval:
-            self.log_task = task.LoopingCall(self.log_stats)
+            # withCount skips iterations fired before the interval elapsed,
+            # which can happen with some reactors
+            self.log_task = task.LoopingCall.withCount(lambda count: self.log_stats())
+            self.log_task.clock = self.clock
             self.log_task.start(self.logstats_interval, now=True)
+        else:
+            # log_stats isn't called, but proxies/* stats should exist anyway
+            self.update_stats()
+
+        self.schedule_reanimation()
 
-        if self.reanimate_interval:
-            self.reanimate_task = task.LoopingCall(self.reanimate_proxies)
-            self.reanimate_task.start(self.reanimate_interval, now=False)
+    def schedule_reanimation(self, next_check=None):
+        """
+        Arrange for dead proxies to be reanimated when the earliest backoff
+        expires, but not more often than every ``reanimate_interval`` seconds.
+        Nothing is scheduled while there are no dead proxies.
+
+        When ``next_check`` is given (a proxy has just died), the pending
+        call is only moved earlier if needed, without scanning all
+        dead proxies.
+        """
+        if not self.reanimate_interval:
+            return
+        if next_check is None:
+            next_check = self.proxies.next_reanimation_time()
+            if next_check is None:
+                return
+
+        now = self.clock.seconds()
+        delay = max(next_check - now, self.reanimate_interval)
+        call = self.reanimate_task
+        if call is not None and call.active():
+            if call.getTime() - now > delay:
+                call.reset(delay)
+        else:
+            self.reanimate_task = self.clock.callLater(delay, self.reanimate_proxies)
 
     def reanimate_proxies(self):
-        n_reanimated = self.proxies.reanimate()
+        n_reanimated = self.proxies.reanimate(self.clock.seconds())
         if n_reanimated:
             logger.debug("%s proxies moved from 'dead' to 'reanimated'", n_reanimated)
+        self.schedule_reanimation()
+
+    def spider_closed(self):
+        # stats are dumped right after this signal; make sure they are fresh
+        self.update_stats()
 
     def engine_stopped(self):
         if self.log_task and self.log_task.running:
             self.log_task.stop()
 
-        if self.reanimate_task and self.reanimate_task.running:
-            self.reanimate_task.stop()
+        if self.reanimate_task and self.reanimate_task.active():
+            self.reanimate_task.cancel()
 
     def process_request(self, request, spider):
-        if "proxy" in request.meta and not request.meta.get("_rotating_proxy"):
+        meta = request.meta
+        if "proxy" in meta and not meta.get("_rotating_proxy"):
             return
-        proxy = self.proxies.get_random()
+        proxy = self._get_random()
         if not proxy:
             if self.stop_if_no_proxies:
                 raise CloseSpider("no_proxies")
@@ -142,15 +212,18 @@ class RotatingProxyMiddleware:
                     logger.error("No proxies available even after a reset.")
                     raise CloseSpider("no_proxies_after_reset")
 
-        request.meta["proxy"] = proxy
-        request.meta["download_slot"] = self.get_proxy_slot(proxy)
-        request.meta["_rotating_proxy"] = True
+        meta["proxy"] = proxy
+        meta["download_slot"] = self._slot_by_proxy[proxy]
+        meta["_rotating_proxy"] = True
 
     def get_proxy_slot(self, proxy):
         """
         Return downloader slot for a proxy.
         By default it doesn't take port in account, i.e. all proxies with
         the same hostname / ip address share the same slot.
+
+        It is called once per proxy when the middleware is created;
+        the result is reused for every request, including retries.
         """
         # FIXME: an option to use website address as a part of slot as well?
         return urlsplit(proxy).hostname
@@ -162,47 +235,45 @@ class RotatingProxyMiddleware:
         return self._handle_result(request, spider) or response
 
     def _handle_result(self, request, spider):
-        proxy = self.proxies.get_proxy(request.meta.get("proxy", None))
-        if not (proxy and request.meta.get("_rotating_proxy")):
+        meta = request.meta
+        if not meta.get("_rotating_proxy"):
             return
-        self.stats.set_value(
-            "proxies/unchecked",
-            len(self.proxies.unchecked) - len(self.proxies.reanimated),
-        )
-        self.stats.set_value("proxies/reanimated", len(self.proxies.reanimated))
-        self.stats.set_value("proxies/mean_backoff", self.proxies.mean_backoff_time)
-        ban = request.meta.get("_ban", None)
+        proxy = self._get_proxy(meta.get("proxy"))
+        if not proxy:
+            return
+        ban = meta.get("_ban")
         if ban is True:
-            self.proxies.mark_dead(proxy)
-            self.stats.set_value("proxies/dead", len(self.proxies.dead))
+            self.proxies.mark_dead(proxy, self.clock.seconds())
+            self.schedule_reanimation(self.proxies.proxies[proxy].next_check)
             return self._retry(request, spider)
         elif ban is False:
             self.proxies.mark_good(proxy)
-            self.stats.set_value("proxies/good", len(self.proxies.good))
 
     def _retry(self, request, spider):
         retries = request.meta.get("proxy_retry_times", 0) + 1
         max_proxies_to_try = request.meta.get(
             "max_proxies_to_try", self.max_proxies_to_try
         )
+        # avoid building log arguments when DEBUG messages are discarded
+        debug = logger.isEnabledFor(logging.DEBUG)
 
         if retries <= max_proxies_to_try:
-            logger.debug(
-                "Retrying %(request)s with another proxy "
-                "(failed %(retries)d times, "
-                "max retries: %(max_proxies_to_try)d)",
-                {
-                    "request": request,
-                    "retries": retries,
-                    "max_proxies_to_try": max_proxies_to_try,
-                },
-                extra={"spider": spider},
-            )
-            retryreq = request.copy()
+            if debug:
+                logger.debug(
+                    "Retrying %(request)s with another proxy "
+                    "(failed %(retries)d times, "
+                    "max retries: %(max_proxies_to_try)d)",
+                    {
+                        "request": request,
+                        "retries": retries,
+                        "max_proxies_to_try": max_proxies_to_try,
+                    },
+                    extra={"spider": spider},
+                )
+            retryreq = request.replace(dont_filter=True)
             retryreq.meta["proxy_retry_times"] = retries
-            retryreq.dont_filter = True
             return retryreq
-        else:
+        elif debug:
             logger.debug(
                 "Gave up retrying %(request)s (failed %(retries)d "
                 "times with different proxies)",
@@ -211,15 +282,32 @@ class RotatingProxyMiddleware:
             )
 
     def log_stats(self):
+        # nothing to report if proxy states haven't changed since last time
+        version = self.proxies.version
+        if version == self._logged_version:
+            return
+        self._logged_version = version
         logger.info("%s", self.proxies)
+        self.update_stats()
+
+    def update_stats(self):
+        n_reanimated = len(self.proxies.reanimated)
+        self.stats.set_value(
+            "proxies/unchecked", len(self.proxies.unchecked) - n_reanimated
+        )
+        self.stats.set_value("proxies/reanimated", n_reanimated)
+        self.stats.set_value("proxies/mean_backoff", self.proxies.mean_backoff_time)
+        self.stats.set_value("proxies/dead", len(self.proxies.dead))
+        self.stats.set_value("proxies/good", len(self.proxies.good))
 
     @classmethod
     def cleanup_proxy_list(cls, proxy_list):
-        lines = [line.strip() for line in proxy_list]
+        # deduplicate before normalizing, so that the scheme is only
+        # added once per unique line
+        lines = {line.strip() for line in proxy_list}
+        lines.discard("")
         return list({
-            add_http_if_no_scheme(url)
-            for url in lines
-            if url and not url.startswith("#")
+            ensure_scheme(url) for url in lines if not url.startswith("#")
         })
 
 
@@ -278,9 +366,23 @@ class BanDetectionMiddleware:
 
     """
 
+    __slots__ = (
+        "stats",
+        "policy",
+        "_inc_stat",
+        "_spider",
+        "_response_is_ban",
+        "_exception_is_ban",
+        "__weakref__",
+    )
+
     def __init__(self, stats, policy):
         self.stats = stats
         self.policy = policy
+        self._inc_stat = stats.inc_value
+        self._spider = _UNBOUND
+        self._response_is_ban = policy.response_is_ban
+        self._exception_is_ban = policy.exception_is_ban
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -297,22 +399,43 @@ class BanDetectionMiddleware:
         else:
             return policy_cls()
 
+    def _bind_ban_checks(self, spider):
+        """Resolve ban detection methods, preferring the spider's own"""
+        self._spider = spider
+        self._response_is_ban = getattr(
+            spider, "response_is_ban", self.policy.response_is_ban
+        )
+        self._exception_is_ban = getattr(
+            spider, "exception_is_ban", self.policy.exception_is_ban
+        )
+
     def process_response(self, request, response, spider):
-        is_ban = getattr(spider, "response_is_ban", self.policy.response_is_ban)
-        ban = is_ban(request, response)
+        if spider is not self._spider:
+            self._bind_ban_checks(spider)
+        ban = self._response_is_ban(request, response)
         request.meta["_ban"] = ban
         if ban:
-            self.stats.inc_value(f"bans/status/{response.status}")
-            if not len(response.body):
-                self.stats.inc_value("bans/empty")
+            status = response.status
+            self._inc_stat(_status_stat_key(status))
+            # 204 and 304 responses never have a body
+            if status not in (204, 304) and not response.body:
+                self._inc_stat("bans/empty")
         return response
 
     def process_exception(self, request, exception, spider):
-        is_ban = getattr(spider, "exception_is_ban", self.policy.exception_is_ban)
-        ban = is_ban(request, exception)
+        if spider is not self._spider:
+            self._bind_ban_checks(spider)
+        ban = self._exception_is_ban(request, exception)
         if ban:
-            ex_class = (
-                f"{exception.__class__.__module__}.{exception.__class__.__name__}"
-            )
-            self.stats.inc_value(f"bans/error/{ex_class}")
+            self._inc_stat(_exception_stat_key(exception.__class__))
         request.meta["_ban"] = ban
+
+
+@lru_cache(maxsize=None)
+def _status_stat_key(status):
+    return f"bans/status/{status}"
+
+
+@lru_cache(maxsize=None)
+def _exception_stat_key(exception_class):
+    return f"bans/error/{exception_class.__module__}.{exception_class.__name__}"
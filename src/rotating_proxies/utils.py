@@ -1,5 +1,7 @@
 from urllib.request import _parse_proxy
 
+from scrapy.utils.url import add_http_if_no_scheme
+
 
 def extract_proxy_hostport(proxy):
     """
@@ -21,3 +23,20 @@ def extract_proxy_hostport(proxy):
     'baz:1234'
     """
     return _parse_proxy(proxy)[3]
+
+
+def ensure_scheme(proxy):
+    """
+    Return a given proxy with an "http://" scheme added if it has none:
+
+    >>> ensure_scheme("http://x")
+    'http://x'
+    >>> ensure_scheme("https://x")
+    'https://x'
+    >>> ensure_scheme("x:1")
+    'http://x:1'
+    """
+    # most proxy lists use http:// explicitly; avoid the regex for them
+    if proxy.startswith(("http://", "https://")):
+        return proxy
+    return add_http_if_no_scheme(proxy)